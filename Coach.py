@@ -1,13 +1,12 @@
 import logging
 import os
 import sys
-from collections import deque
 import pickle
 import zlib
-from random import shuffle
 import time
 
 import numpy as np
+import torch.multiprocessing as mp
 from tqdm import tqdm
 
 from Arena import Arena
@@ -15,6 +14,120 @@ from MCTS import MCTS
 
 log = logging.getLogger(__name__)
 
+# Entry point of self-play processes, see Coach.selfPlayParallel()
+def selfPlayWorker(worker_id, game_class, nnet_class, nn_args, nnet_module, args, nb_episodes, queue):
+    game = game_class() # game itself can't be pickled because of numba
+    nnet = nnet_class(game, nn_args)
+    nnet.nnet = nnet_module
+    mcts = MCTS(game, nnet, args, dirichlet_noise=(args.dirichletAlpha>0)) # same as Coach.mcts, no need for a whole Coach
+    for _ in range(nb_episodes[worker_id]):
+        queue.put(executeEpisode(game, mcts, args))
+        MCTS.reset_all_search_trees()
+
+def executeEpisode(game, mcts, args):
+    """
+    This function executes one episode of self-play, starting with player 1.
+    As the game is played, each turn is added as a training example to
+    trainExamples. The game is played till the game ends. After the game
+    ends, the outcome of the game is used to assign values to each example
+    in trainExamples.
+
+    It uses a temp=1 if episodeStep < tempThreshold, and thereafter
+    uses temp=0.
+
+    Returns:
+        trainExamples: a list of examples of the form (canonicalBoard, pi, v, scdiff, valids, surprise)
+                       pi is the MCTS informed policy vector, v is +1 if
+                       the player eventually won the game, else -1.
+    """
+    trainExamples = []
+    board = game.getInitBoard()
+    curPlayer = 0
+    episodeStep = 0
+
+    while True:
+        episodeStep += 1
+        canonicalBoard = game.getCanonicalForm(board, curPlayer)
+        temp = int(episodeStep < args.tempThreshold)
+
+        pi, surprise, is_full_search = mcts.getActionProb(canonicalBoard, temp=temp)
+        if is_full_search:
+            valids = game.getValidMoves(canonicalBoard, 0)
+            sym = game.getSymmetries(canonicalBoard, pi, valids)
+            for b, p, v in sym:
+                trainExamples.append([b, curPlayer, p, v, surprise])
+
+        action = np.random.choice(len(pi), p=pi)
+        board, curPlayer = game.getNextState(board, curPlayer, action)
+
+        r = game.getGameEnded(board, curPlayer)
+        if r.any():
+            final_scores = [game.getScore(board, p) for p in range(game.num_players)]
+            trainExamples = [(
+                x[0],                                # board
+                x[2],                                # policy
+                np.roll(r, -x[1]),                   # winner
+                np.roll([f-final_scores[x[1]] for f in final_scores], -x[1]), # score difference
+                x[3],                                # valids
+                x[4],                                # surprise
+            ) for x in trainExamples]
+
+            return trainExamples
+
+class ExamplesBuffer():
+    """
+    Stores training examples as a structure of arrays: one numpy array per
+    field (board, policy, value, score difference, valids, surprise), each of
+    maxlen rows. Arrays are allocated when the first example is added, using
+    its shapes and dtypes. Once full, oldest examples are overwritten.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.fields = None
+        self.cursor = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def allocate(self, example):
+        # One array per field, with shape and dtype of the given example
+        self.fields = [np.empty((self.maxlen,) + np.shape(f), dtype=np.asarray(f).dtype) for f in example]
+        return self
+
+    def extend(self, examples):
+        for example in examples:
+            if self.fields is None:
+                self.allocate(example)
+            for array, f in zip(self.fields, example):
+                array[self.cursor] = f
+            self.cursor = (self.cursor + 1) % self.maxlen
+            self.length = min(self.length + 1, self.maxlen)
+        return self
+
+    def reset(self):
+        # Keep allocated arrays, only forget examples
+        self.cursor, self.length = 0, 0
+        return self
+
+    def arrays(self):
+        return [array[:self.length] for array in self.fields] if self.fields is not None else []
+
+    def truncate(self, length):
+        self.length = min(self.length, length)
+        self.cursor = self.length % self.maxlen
+
+    def __getstate__(self):
+        # Only save filled rows
+        return {'maxlen': self.maxlen, 'length': self.length, 'fields': self.arrays() or None}
+
+    def __setstate__(self, state):
+        # Arrays were trimmed to filled rows when saved
+        self.maxlen, self.length, self.cursor = max(state['length'], 1), state['length'], 0
+        self.fields = state['fields']
+
+
 class Coach():
     """
     This class executes the self-play + learning. It uses the functions defined
@@ -28,57 +141,12 @@ class Coach():
         self.args = args
         self.mcts = MCTS(self.game, self.nnet, self.args, dirichlet_noise=(self.args.dirichletAlpha>0))
         self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        self.buffersPool = []  # example buffers that can be reused, see preallocate()
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
 
     def executeEpisode(self):
-        """
-        This function executes one episode of self-play, starting with player 1.
-        As the game is played, each turn is added as a training example to
-        trainExamples. The game is played till the game ends. After the game
-        ends, the outcome of the game is used to assign values to each example
-        in trainExamples.
-
-        It uses a temp=1 if episodeStep < tempThreshold, and thereafter
-        uses temp=0.
-
-        Returns:
-            trainExamples: a list of examples of the form (canonicalBoard, currPlayer, pi,v)
-                           pi is the MCTS informed policy vector, v is +1 if
-                           the player eventually won the game, else -1.
-        """
-        trainExamples = []
-        board = self.game.getInitBoard()
-        self.curPlayer = 0
-        episodeStep = 0
-
-        while True:
-            episodeStep += 1
-            canonicalBoard = self.game.getCanonicalForm(board, self.curPlayer)
-            temp = int(episodeStep < self.args.tempThreshold)
-
-            pi, surprise, is_full_search = self.mcts.getActionProb(canonicalBoard, temp=temp)
-            if is_full_search:
-                valids = self.game.getValidMoves(canonicalBoard, 0)
-                sym = self.game.getSymmetries(canonicalBoard, pi, valids)
-                for b, p, v in sym:
-                    trainExamples.append([b, self.curPlayer, p, v, surprise])
-
-            action = np.random.choice(len(pi), p=pi)
-            board, self.curPlayer = self.game.getNextState(board, self.curPlayer, action)
-
-            r = self.game.getGameEnded(board, self.curPlayer)
-            if r.any():
-                final_scores = [self.game.getScore(board, p) for p in range(self.game.num_players)]
-                trainExamples = [(
-                    x[0],                                # board
-                    x[2],                                # policy
-                    np.roll(r, -x[1]),                   # winner
-                    np.roll([f-final_scores[x[1]] for f in final_scores], -x[1]), # score difference
-                    x[3],                                # valids
-                    x[4],                                # surprise
-                ) for x in trainExamples]
-
-                return trainExamples if self.args.no_compression else [zlib.compress(pickle.dumps(x), level=1) for x in trainExamples]
+        # see executeEpisode() at module level
+        return executeEpisode(self.game, self.mcts, self.args)
 
     def learn(self):
         """
@@ -96,14 +164,17 @@ class Coach():
             log.info(f'Starting Iter #{i} ...')
             # examples of the iteration
             if not self.skipFirstSelfPlay or i > 1:
-                iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+                iterationTrainExamples = self.buffersPool.pop().reset() if self.buffersPool else ExamplesBuffer(self.args.maxlenOfQueue)
 
-                for _ in tqdm(range(self.args.numEps), desc="Self Play", ncols=120):
-                    iterationTrainExamples += self.executeEpisode()
-                    MCTS.reset_all_search_trees()
-                    if len(iterationTrainExamples) == self.args.maxlenOfQueue:
-                        log.warning(f'saturation of elements in iterationTrainExamples, think about decreasing numEps or increasing maxlenOfQueue')
-                        break
+                if self.args.num_workers > 1:
+                    self.selfPlayParallel(iterationTrainExamples)
+                else:
+                    for _ in tqdm(range(self.args.numEps), desc="Self Play", ncols=120):
+                        iterationTrainExamples.extend(self.executeEpisode())
+                        MCTS.reset_all_search_trees()
+                        if len(iterationTrainExamples) == self.args.maxlenOfQueue:
+                            log.warning(f'saturation of elements in iterationTrainExamples, think about decreasing numEps or increasing maxlenOfQueue')
+                            break
 
                 # save the iteration examples to the history 
                 self.trainExamplesHistory.append(iterationTrainExamples)
@@ -112,14 +183,13 @@ class Coach():
                 return
 
             if len(self.trainExamplesHistory) > self.args.numItersHistory:
-                self.trainExamplesHistory.pop(0)
+                oldestExamples = self.trainExamplesHistory.pop(0)
+                if oldestExamples.maxlen == self.args.maxlenOfQueue:
+                    self.buffersPool.append(oldestExamples)
             # backup history to a file
             self.saveTrainExamples()
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+            # views on examples of each iteration, no copy and no need to shuffle since training picks random samples
+            trainExamples = [history.arrays() for history in self.trainExamplesHistory if len(history) > 0]
 
             # training new network, keeping a copy of the old one
             self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pt', additional_keys=vars(self.args))
@@ -142,6 +212,55 @@ class Coach():
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(i), additional_keys=vars(self.args))
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pt', additional_keys=vars(self.args))
 
+    def selfPlayParallel(self, iterationTrainExamples):
+        """
+        Plays numEps episodes of self-play split over num_workers processes,
+        each one using its own copy of the network. Examples are sent back
+        through a queue after each episode. Like the serial loop, stops once
+        iterationTrainExamples is saturated.
+
+        Returns:
+            number of episodes whose examples were added
+        """
+        nb_episodes = [len(x) for x in np.array_split(range(self.args.numEps), self.args.num_workers)]
+        queue = mp.get_context('spawn').SimpleQueue()
+        workers = mp.spawn(selfPlayWorker, args=(type(self.game), type(self.nnet), self.nnet.args, self.nnet.nnet, self.args, nb_episodes, queue), nprocs=self.args.num_workers, join=False)
+        with tqdm(total=self.args.numEps, desc="Self Play", ncols=120) as t:
+            while t.n < self.args.numEps:
+                if queue.empty():
+                    # Don't block on the queue: join() raises if a worker died, instead of waiting forever
+                    if workers.join(timeout=1) and queue.empty():
+                        break
+                    continue
+                iterationTrainExamples.extend(queue.get())
+                t.update()
+                if len(iterationTrainExamples) == self.args.maxlenOfQueue:
+                    log.warning(f'saturation of elements in iterationTrainExamples, think about decreasing numEps or increasing maxlenOfQueue')
+                    break
+        # Remaining workers, if any, are not needed anymore
+        for process in workers.processes:
+            process.terminate()
+            process.join()
+        return t.n
+
+    def preallocate(self, maxlen):
+        """
+        Allocates once the example buffers needed for whole training: one per
+        iteration kept in history, plus the one of current iteration. Buffers
+        leaving history are then reused instead of allocating new ones.
+        """
+        template = self.exampleTemplate()
+        self.buffersPool = [ExamplesBuffer(maxlen).allocate(template) for _ in range(self.args.numItersHistory + 1 - len(self.trainExamplesHistory))]
+
+    def exampleTemplate(self):
+        # Example with same shapes and dtypes as those of executeEpisode(), values don't matter
+        board = self.game.getCanonicalForm(self.game.getInitBoard(), 0)
+        valids = self.game.getValidMoves(board, 0)
+        b, p, v = self.game.getSymmetries(board, [1. / len(valids)] * len(valids), valids)[0]
+        r = self.game.getGameEnded(board, 0)
+        scores = [self.game.getScore(board, player) for player in range(self.game.num_players)]
+        return (b, p, np.roll(r, 0), np.roll([f-scores[0] for f in scores], 0), v, 0.)
+
     def getCheckpointFile(self, iteration):
         return 'checkpoint_' + str(iteration) + '.pt'
 
@@ -167,15 +286,11 @@ class Coach():
         with open(examplesFile, "rb") as f:
             self.trainExamplesHistory = pickle.load(f)
         
-        # Harmonize compression use in loaded examples
-        if type(self.trainExamplesHistory[0][0]) is tuple and not self.args.no_compression:
-            for i in range(len(self.trainExamplesHistory)):
-                for j in range(len(self.trainExamplesHistory[i])):                    
-                    self.trainExamplesHistory[i][j] = zlib.compress(pickle.dumps(self.trainExamplesHistory[i][j]), level=1)
-        elif type(self.trainExamplesHistory[0][0]) is not tuple and self.args.no_compression:
-            for i in range(len(self.trainExamplesHistory)): 
-                for j in range(len(self.trainExamplesHistory[i])):
-                    self.trainExamplesHistory[i][j] = pickle.loads(zlib.decompress(self.trainExamplesHistory[i][j]))
+        # Convert examples saved in previous format (list of examples, possibly compressed)
+        for i, history in enumerate(self.trainExamplesHistory):
+            if not isinstance(history, ExamplesBuffer):
+                examples = [x if type(x) is tuple else pickle.loads(zlib.decompress(x)) for x in history]
+                self.trainExamplesHistory[i] = ExamplesBuffer(max(len(examples), 1)).extend(examples)
         log.info('Loading done!')
 
         # cleaning
@@ -184,6 +299,5 @@ class Coach():
             log.info('Reduced history in loaded examples')
         for history in self.trainExamplesHistory:
             if len(history) > self.args.maxlenOfQueue:
-                for _ in range(len(history), self.args.maxlenOfQueue, -1):
-                    history.pop()
+                history.truncate(self.args.maxlenOfQueue)
                 log.info('Reduced nb of items in one history of loaded examples')
@@ -1,8 +1,7 @@
 import os
 import sys
 import time
-import pickle
-import zlib
+import copy
 
 os.environ["OMP_NUM_THREADS"] = "1" # PyTorch more efficient this way
 
@@ -14,6 +13,7 @@ from utils import *
 from NeuralNet import NeuralNet
 
 import torch
+import torch.nn as nn
 import torch.optim as optim
 import torch.onnx
 import onnxruntime as ort
@@ -24,12 +24,14 @@ class GenericNNetWrapper(NeuralNet):
 		self.args = nn_args
 		self.device = {
 			'training' : 'cpu', #'cuda' if torch.cuda.is_available() else 'cpu',
-			'inference': 'onnx',
+			'inference': nn_args.get('inference_device', 'onnx'),
 			'just_loaded': 'cpu',
 		}
 		self.current_mode = 'cpu'
 		self.init_nnet(game, nn_args)
 		self.ort_session = None
+		self.nnet_for_inference = None
+		self.pinned_boards, self.pinned_valids = None, None
 
 		self.nb_vect, self.vect_dim = game.getBoardSize()
 		self.action_size = game.getActionSize()
@@ -42,13 +44,16 @@ class GenericNNetWrapper(NeuralNet):
 
 	def train(self, examples):
 		"""
-		examples: list of examples, each example is of form (board, pi, v)
+		examples: list of parts (one per iteration of history), each part being a list of arrays
+		          (boards, pis, vs, scdiffs, valid_actions, surprises) with one row per example
 		"""
 		self.switch_target('training')
+		self.nnet_for_inference = None # Make inference network invalid
 
 		if self.optimizer is None:
 			self.optimizer = optim.Adam(self.nnet.parameters(), lr=self.args['learn_rate'])		
-		batch_count = int(len(examples) / self.args['batch_size'])
+		nb_examples = sum(len(part[0]) for part in examples)
+		batch_count = int(nb_examples / self.args['batch_size'])
 
 		if self.args['cyclic_lr']:
 			scheduler = optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=self.args['learn_rate']*10, anneal_strategy='cos', total_steps=self.args['epochs']*batch_count)
@@ -63,12 +68,12 @@ class GenericNNetWrapper(NeuralNet):
 			pi_losses, v_losses, scdiff_losses = AverageMeter(), AverageMeter(), AverageMeter()
 	
 			for _ in range(batch_count):
-				sample_ids = np.random.choice(len(examples), size=self.args['batch_size'], replace=False, p=examples_weights)
+				sample_ids = np.random.choice(nb_examples, size=self.args['batch_size'], replace=False, p=examples_weights)
 				boards, pis, vs, scdiffs, valid_actions, surprises = self.pick_examples(examples, sample_ids)
-				boards = torch.FloatTensor(self.reshape_boards(np.array(boards)).astype(np.float32))
-				valid_actions = torch.BoolTensor(np.array(valid_actions).astype(np.bool_))
-				target_pis = torch.FloatTensor(np.array(pis).astype(np.float32))
-				target_vs = torch.FloatTensor(np.array(vs).astype(np.float32))
+				boards = torch.from_numpy(self.reshape_boards(boards).astype(np.float32))
+				valid_actions = torch.from_numpy(valid_actions.astype(np.bool_))
+				target_pis = torch.from_numpy(pis.astype(np.float32))
+				target_vs = torch.from_numpy(vs.astype(np.float32))
 				target_scdiffs = torch.FloatTensor(np.zeros((len(scdiffs), 2*self.max_diff+1, self.num_players)).astype(np.float32))
 				for i in range(len(scdiffs)):
 					score_diff = (scdiffs[i] + self.max_diff).clip(0, 2*self.max_diff)
@@ -108,30 +113,76 @@ class GenericNNetWrapper(NeuralNet):
 		"""
 		board: np array with board
 		"""
-		# timing
+		pi, v = self.predict_batch(board, valid_actions)
+		return pi[0], v[0]
 
+	def predict_batch(self, boards, valid_actions):
+		"""
+		boards: np array with stacked boards
+		valid_actions: np array with stacked valid actions
+		"""
 		# preparing input
 		self.switch_target('inference')
 
 		if self.current_mode == 'onnx':
 			ort_outs = self.ort_session.run(None, {
-				'board': board.astype(np.float32).reshape((-1, self.nb_vect, self.vect_dim)),
-				'valid_actions': np.array(valid_actions).astype(np.bool_).reshape((-1, self.action_size)),
+				'board': boards.astype(np.float32).reshape((-1, self.nb_vect, self.vect_dim)),
+				'valid_actions': np.asarray(valid_actions, dtype=np.bool_).reshape((-1, self.action_size)),
 			})
-			pi, v = np.exp(ort_outs[0][0]), ort_outs[1][0]
+			pi, v = np.exp(ort_outs[0]), ort_outs[1]
 			return pi, v
 
 		else:
-			board = torch.FloatTensor(board.astype(np.float32)).reshape((-1, self.nb_vect, self.vect_dim))
-			valid_actions = torch.BoolTensor(np.array(valid_actions).astype(np.bool_)).reshape((-1, self.action_size))
+			boards = boards.reshape((-1, self.nb_vect, self.vect_dim))
+			valid_actions = np.asarray(valid_actions, dtype=np.bool_).reshape((-1, self.action_size)) # no copy when already bool
+			n, batch_size = boards.shape[0], self.args.get('mcts_batch_size', 1)
+			if self.args.get('compile_inference') and 1 < n < batch_size:
+				# Compiled network is specialized on input shape: pad partial batches so that only
+				# 2 shapes (single board and full MCTS batch) are ever compiled and recorded
+				boards = np.concatenate([boards, np.zeros((batch_size - n,) + boards.shape[1:], dtype=boards.dtype)])
+				valid_actions = np.concatenate([valid_actions, np.ones((batch_size - n, self.action_size), dtype=np.bool_)])
 			if self.current_mode == 'cuda':
-				board, valid_actions = board.contiguous().cuda(), valid_actions.contiguous().cuda()
-			self.nnet.eval()
-			with torch.no_grad():
-				pi, v, _ = self.nnet(board, valid_actions)
-			pi, v = torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+				boards, valid_actions = self.copy_to_gpu(boards, valid_actions)
+			else:
+				boards, valid_actions = torch.from_numpy(boards.astype(np.float32)), torch.from_numpy(valid_actions)
+			nnet = self.inference_nnet()
+			# Half precision on GPU for inference only, training stays in FP32. bf16 only when natively supported (Ampere+)
+			half_dtype = torch.bfloat16 if self.current_mode == 'cuda' and torch.cuda.get_device_capability() >= (8, 0) else torch.float16
+			# Outputs are never backpropagated, so skip version counter bookkeeping too
+			with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=half_dtype, enabled=(self.current_mode == 'cuda')):
+				pi, v, _ = nnet(boards, valid_actions)
+			pi, v = torch.exp(pi[:n].float()).data.cpu().numpy(), v[:n].float().data.cpu().numpy()
 			return pi, v
 
+	def copy_to_gpu(self, boards, valid_actions):
+		# Stage inputs in pinned memory so that copies to GPU are asynchronous. Buffers can be
+		# reused at next call since outputs are synchronously copied back before returning.
+		# Numpy inputs are written (and cast) directly in pinned memory, without intermediate tensor
+		n = boards.shape[0]
+		if self.pinned_boards is None or self.pinned_boards.shape[0] < n:
+			self.pinned_boards = torch.empty((n, self.nb_vect, self.vect_dim), dtype=torch.float32, pin_memory=True)
+			self.pinned_valids = torch.empty((n, self.action_size), dtype=torch.bool, pin_memory=True)
+		self.pinned_boards[:n].numpy()[:] = boards
+		self.pinned_valids[:n].numpy()[:] = valid_actions
+		return self.pinned_boards[:n].to('cuda', non_blocking=True), self.pinned_valids[:n].to('cuda', non_blocking=True)
+
+	def inference_nnet(self):
+		# Copy of self.nnet used for inference only, so it can be transformed without impacting training and checkpoints
+		if self.nnet_for_inference is None:
+			nnet = self.prepare_inference_nnet(copy.deepcopy(self.nnet).eval())
+			if self.args.get('compile_inference'):
+				# Compiled network replays CUDA graphs, removing python and kernel launch overhead on small batches
+				nnet = torch.compile(nnet, mode='reduce-overhead', fullgraph=True, dynamic=False)
+			self.nnet_for_inference = nnet
+		return self.nnet_for_inference
+
+	def prepare_inference_nnet(self, nnet):
+		# Some game may transform network before using it for inference, call this one too
+		for module in list(nnet.modules()):
+			if type(module) is nn.Sequential:
+				fuse_linear_batchnorm(module)
+		return nnet
+
 	def loss_pi(self, targets, outputs):
 		return -torch.sum(targets * outputs) / targets.size()[0]
 
@@ -208,6 +259,7 @@ class GenericNNetWrapper(NeuralNet):
 				# else:
 				# 	print(f'hasnt loaded layer {name} because not in target')
 
+		self.nnet_for_inference = None # Make inference network invalid
 		try:
 			self.nnet.load_state_dict(checkpoint['state_dict'])
 		except:
@@ -233,14 +285,17 @@ class GenericNNetWrapper(NeuralNet):
 			self.nnet.cpu()
 			torch.cuda.empty_cache()
 			self.ort_session = None # Make ONNX export invalid
+			self.nnet_for_inference = None # Make inference network invalid
 		elif target_device == 'onnx':
 			self.nnet.cpu()
 			self.export_and_load_onnx()
 		elif target_device == 'cuda':
 			self.nnet.cuda()
 			self.ort_session = None # Make ONNX export invalid
+			self.nnet_for_inference = None # Make inference network invalid
 		elif target_device == 'just_loaded':
 			self.ort_session = None # Make ONNX export invalid
+			self.nnet_for_inference = None # Make inference network invalid
 		
 		self.current_mode = target_device
 
@@ -250,7 +305,7 @@ class GenericNNetWrapper(NeuralNet):
 		self.nnet.to('cpu')
 		self.nnet.eval()
 
-		temporary_file = 'nn_export_' + str( int(time.time()*1000)%1000000 ) + '.onnx'
+		temporary_file = 'nn_export_' + str(os.getpid()) + '_' + str( int(time.time()*1000)%1000000 ) + '.onnx'
 
 		# 		Measured avg duration of inference over 5 tests of 20k calls, 1 inference each time
 		#       Checked that variability is < ±0.05, W means warning emitted
@@ -288,17 +343,20 @@ class GenericNNetWrapper(NeuralNet):
 		os.remove(temporary_file)
 
 	def pick_examples(self, examples, sample_ids):
-		if self.args['no_compression']:
-			picked_examples = [examples[i] for i in sample_ids]
-		else: 
-			picked_examples = [pickle.loads(zlib.decompress(examples[i])) for i in sample_ids]
-		return list(zip(*picked_examples))
+		# sample_ids index all parts as if they were concatenated, gather rows part by part to avoid that copy
+		ends = np.cumsum([len(part[0]) for part in examples])
+		part_ids = np.searchsorted(ends, sample_ids, side='right')
+		picked_examples = [np.empty((len(sample_ids),) + array.shape[1:], dtype=array.dtype) for array in examples[0]]
+		for i, part in enumerate(examples):
+			in_part = (part_ids == i)
+			if in_part.any():
+				ids_in_part = sample_ids[in_part] - (ends[i] - len(part[0]))
+				for picked, array in zip(picked_examples, part):
+					picked[in_part] = array[ids_in_part]
+		return picked_examples
 
 	def compute_surprise_weights(self, examples):
-		if self.args['no_compression']:
-			examples_surprises = np.array([x[-1] for x in examples])
-		else:
-			examples_surprises = np.array([pickle.loads(zlib.decompress(x))[-1] for x in examples])
+		examples_surprises = np.concatenate([part[-1] for part in examples]) # one value per example, cheap to copy
 		examples_weights = examples_surprises / examples_surprises.sum() + 1./len(examples_surprises)
 		examples_weights = examples_weights / examples_weights.sum()
 
@@ -306,4 +364,23 @@ class GenericNNetWrapper(NeuralNet):
 	
 	def reshape_boards(self, numpy_boards):
 		# Some game needs to reshape boards before being an input of NNet
-		return numpy_boards
\ No newline at end of file
+		return numpy_boards
+
+
+# At inference, BatchNorm on a single channel is an affine transform with scalar
+# coefficients, so it can be folded into the Linear layer just before
+def fuse_linear_batchnorm(sequential):
+	for i in range(len(sequential) - 1):
+		linear, bn = sequential[i], sequential[i+1]
+		if type(linear) is not nn.Linear or linear.bias is None:
+			continue
+		if type(bn) is not nn.BatchNorm1d or bn.num_features != 1 or not bn.track_running_stats:
+			continue
+		with torch.no_grad():
+			scale = torch.rsqrt(bn.running_var + bn.eps)
+			shift = -bn.running_mean * scale
+			if bn.affine:
+				scale, shift = scale * bn.weight, shift * bn.weight + bn.bias
+			linear.weight.mul_(scale)
+			linear.bias.mul_(scale).add_(shift)
+		sequential[i+1] = nn.Identity()
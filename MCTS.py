@@ -51,9 +51,16 @@ class MCTS():
         is_full_search = force_full_search or (self.rng.random() < self.args.prob_fullMCTS)
         nb_MCTS_sims = self.args.numMCTSSims if is_full_search else self.args.numMCTSSims // self.args.ratio_fullMCTS
         forced_playouts = (is_full_search and self.args.forced_playouts)
-        for self.step in range(nb_MCTS_sims):
-            dir_noise = (self.step == 0 and is_full_search and self.dirichlet_noise)
-            self.search(canonicalBoard, dirichlet_noise=dir_noise, forced_playouts=forced_playouts)
+        self.step = 0
+        while self.step < nb_MCTS_sims:
+            if self.step == 0 or self.args.mcts_batch_size <= 1:
+                dir_noise = (self.step == 0 and is_full_search and self.dirichlet_noise)
+                self.search(canonicalBoard, dirichlet_noise=dir_noise, forced_playouts=forced_playouts)
+                self.step += 1
+            else:
+                nb_leaves = min(self.args.mcts_batch_size, nb_MCTS_sims - self.step)
+                self.searchBatch(canonicalBoard, nb_leaves, forced_playouts=forced_playouts)
+                self.step += nb_leaves
 
         s = self.game.stringRepresentation(canonicalBoard)
         counts = [self.nodes_data[s][5][a] for a in range(self.game.getActionSize())] # Nsa
@@ -166,6 +173,81 @@ class MCTS():
         return v
 
 
+    def searchBatch(self, canonicalBoard, nb_leaves, forced_playouts=False):
+        """
+        This function performs nb_leaves iterations of MCTS with a single call
+        to the neural network. Each descent applies a virtual loss on the edges
+        it visits, so that next descents of the same batch explore other paths.
+        Leaves are then evaluated all at once, virtual losses are undone and
+        values are propagated up the search paths like in search().
+        """
+        leaves = {} # stores (canonicalBoard, Es, Vs, r, list of paths) for each leaf s
+        terminals = [] # stores (path, Es) for each descent ending on a terminal node
+        virtual_losses = [] # stores (Qsa, Nsa, a, previous Qsa[a], previous Nsa[a]) in order of application
+        for i in range(nb_leaves):
+            path, board = [], canonicalBoard
+            while True:
+                s = self.game.stringRepresentation(board)
+                Es, Vs, Ps, Ns, Qsa, Nsa, r = self.nodes_data.get(s, (None, )*7)
+                if r is None:
+                    r = self.game.getRound(board)
+
+                if Es is None:
+                    Es = self.game.getGameEnded(board, 0)
+                    if Es.any():
+                        # terminal node
+                        self.nodes_data[s] = (Es, Vs, Ps, Ns, Qsa, Nsa, r)
+                if Es.any():
+                    # terminal node, value is already known
+                    terminals.append((path, Es))
+                    break
+
+                if Ps is None:
+                    # First time that we explore state s, evaluation is delayed
+                    if s not in leaves:
+                        leaves[s] = (board, Es, self.game.getValidMoves(board, 0), r, [])
+                    leaves[s][4].append(path)
+                    break
+
+                a, next_s, next_player = get_next_best_action_and_canonical_state(
+                    Es, Vs, Ps, Ns, Qsa, Nsa,
+                    self.args.cpuct,
+                    self.game.board,
+                    board,
+                    forced_playouts,
+                    self.step + i, # index of this simulation, as in search()
+                )
+                virtual_losses.append((Qsa, Nsa, a) + add_virtual_loss(Qsa, Nsa, a))
+                self.nodes_data[s] = (Es, Vs, Ps, Ns + 1, Qsa, Nsa, r)
+                path.append((s, a, next_player))
+                board = next_s
+
+        pis, vs = [], []
+        if leaves:
+            boards = np.array([leaf[0] for leaf in leaves.values()])
+            valids = np.array([leaf[2] for leaf in leaves.values()])
+            pis, vs = self.nnet.predict_batch(boards, valids)
+
+        # Undo in reverse order, so that statistics are exactly restored before adding real values
+        for Qsa, Nsa, a, q, n in reversed(virtual_losses):
+            revert_virtual_loss(Qsa, Nsa, a, q, n)
+
+        for path, Es in terminals:
+            self.backpropagate(path, Es)
+        for (s, (board, Es, Vs, r, leaf_paths)), Ps, v in zip(leaves.items(), pis, vs):
+            normalise(Ps)
+            self.nodes_data[s] = (Es, Vs, Ps, 0, self.Qsa_default.copy(), self.Nsa_default.copy(), r)
+            for path in leaf_paths:
+                self.backpropagate(path, v)
+
+    def backpropagate(self, path, v):
+        # v is the value of the last node of the path, from its own point of view
+        for s, a, next_player in reversed(path):
+            v = np.roll(v, next_player)
+            Qsa, Nsa = self.nodes_data[s][4], self.nodes_data[s][5]
+            Qsa[a] = (Nsa[a] * Qsa[a] + v[0]) / (Nsa[a] + 1) # if Qsa[a] is NAN, then Nsa is zero
+            Nsa[a] += 1 # Ns was already incremented during descent
+
     def applyDirNoise(self, Ps, Vs):
         dir_values = self.rng.dirichlet([self.args.dirichletAlpha] * np.count_nonzero(Vs))
         dir_idx = 0
@@ -225,3 +307,18 @@ def get_next_best_action_and_canonical_state(Es, Vs, Ps, Ns, Qsa, Nsa, cpuct, ga
 def normalise(vector):
     sum_vector = np.sum(vector)
     vector /= sum_vector
+
+# Virtual loss counts one more visit on edge a with a lost game, so that
+# parallel descents avoid it. Previous statistics are returned so that
+# revert_virtual_loss() can restore them exactly, without rounding errors.
+@njit(cache=True, fastmath=True, nogil=True)
+def add_virtual_loss(Qsa, Nsa, a):
+    q, n = Qsa[a], Nsa[a]
+    Qsa[a] = ((n * q if n > 0 else 0.) - 1.) / (n + 1)
+    Nsa[a] = n + 1
+    return q, n
+
+# Several virtual losses on the same edge must be reverted in reverse order
+@njit(cache=True, fastmath=True, nogil=True)
+def revert_virtual_loss(Qsa, Nsa, a, q, n):
+    Qsa[a], Nsa[a] = q, n
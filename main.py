@@ -2,6 +2,9 @@
 
 import logging
 import os
+import glob
+import shutil
+import time
 import coloredlogs
 import argparse
 
@@ -9,7 +12,6 @@ from Coach import Coach
 from santorini.SantoriniGame import SantoriniGame as Game
 from santorini.NNet import NNetWrapper as nn
 from utils import *
-import subprocess
 log = logging.getLogger(__name__)
 coloredlogs.install(level='INFO')  # Change this to DEBUG to see more info.
 
@@ -28,7 +30,9 @@ def run(args):
 		vl_weight=args.vl_weight,
 		cyclic_lr=args.cyclic_lr,
 		surprise_weight=args.surprise_weight,
-		no_compression=args.no_compression,
+		inference_device=args.inference_device,
+		compile_inference=args.compile_inference,
+		mcts_batch_size=args.mcts_batch_size,
 	)
 	nnet = nn(g, nn_args)
 
@@ -45,11 +49,17 @@ def run(args):
 	if args.load_model:
 		log.info("Loading 'trainExamples' from file...")
 		c.loadTrainExamples()
+	c.preallocate(args.maxlenOfQueue)
 
 	# Backup code used for this run
-	subprocess.run(f'mkdir -p "{args.checkpoint}/"', shell=True)
-	subprocess.run(f'cp *py santorini/*py "{args.checkpoint}/"', shell=True)
-	subprocess.run(f'[ -f "{args.checkpoint}/settings.txt" ] && mv "{args.checkpoint}/settings.txt" "{args.checkpoint}/settings."`date +%s` ;   echo "{args}" > "{args.checkpoint}/settings.txt"', shell=True)
+	os.makedirs(args.checkpoint, exist_ok=True)
+	for source_file in glob.glob('*.py') + glob.glob('santorini/*.py'):
+		shutil.copy(source_file, args.checkpoint)
+	settings_file = os.path.join(args.checkpoint, 'settings.txt')
+	if os.path.isfile(settings_file):
+		os.replace(settings_file, os.path.join(args.checkpoint, f'settings.{int(time.time())}'))
+	with open(settings_file, 'w') as f:
+		f.write(f'{args}\n')
 
 	log.debug('Starting the learning process 🎉')
 	c.learn()
@@ -106,8 +116,10 @@ def main():
 	parser.add_argument('--numMCTSSims'     , '-m' , action='store', default=1600 , type=int  , help='Number of moves for MCTS to simulate in FULL exploration')
 	parser.add_argument('--ratio-fullMCTS'         , action='store', default=5    , type=int  , help='Ratio of MCTS sims between full and fast exploration')
 	parser.add_argument('--prob-fullMCTS'          , action='store', default=0.25 , type=float, help='Probability to choose full MCTS exploration')
+	parser.add_argument('--mcts-batch-size'        , action='store', default=1    , type=int  , help='Number of MCTS leaves evaluated by a single NN call, using virtual loss')
 	parser.add_argument('--cpuct'           , '-c' , action='store', default=1.0  , type=float, help='')
 	parser.add_argument('--dirichletAlpha'  , '-d' , action='store', default=0.2  , type=float, help='α=0.3 for chess, scaled in inverse proportion to the approximate number of legal moves in a typical position')    
+	parser.add_argument('--num-workers'     , '-w' , action='store', default=1    , type=int  , help='Number of processes playing self-play episodes in parallel')
 	parser.add_argument('--numItersHistory' , '-i' , action='store', default=5   , type=int  , help='')
 
 	parser.add_argument('--learn-rate'      , '-l' , action='store', default=0.0003, type=float, help='')
@@ -119,7 +131,8 @@ def main():
 	parser.add_argument('--cyclic-lr'       , '-Y' , action='store_true', help='Enable cyclic learning rate')
 	parser.add_argument('--surprise-weight' , '-W' , action='store_true', help='Give more learning weights to surprising results')
 
-	parser.add_argument('--no-compression'  , '-z' , action='store_true', help='Prevent using in-memory data compression (huge memory decrease and impact by only by ~1 second per 100k samples), useful for easier debugging')
+	parser.add_argument('--inference-device'       , action='store', default='onnx', choices=['onnx', 'cpu', 'cuda'], help='How to run NN inference during MCTS')
+	parser.add_argument('--compile-inference'      , action='store_true', help='Compile network for inference with torch.compile (CUDA graphs on GPU), ignored when inference is done via ONNX')
 	parser.add_argument('--no-mem-optim'    , '-Z' , action='store_true', help='Prevent cleaning MCTS tree of old moves during each game')
 	parser.add_argument('--checkpoint'      , '-C' , action='store', default='./temp/', help='')
 	parser.add_argument('--load-folder-file', '-L' , action='store', default=None     , help='')
@@ -44,6 +44,7 @@ def create_player(name, args):
 		'cpuct'           : args.cpuct       if args.cpuct       else additional_keys.get('cpuct'      , 1.0),
 		'prob_fullMCTS'   : 1.,
 		'forced_playouts' : False,
+		'mcts_batch_size' : 1,
 		'no_mem_optim'    : False,
 	})
 	mcts = MCTS(game, net, mcts_args)
@@ -1,4 +1,5 @@
 import sys
+import torch
 sys.path.append('../../')
 from GenericNNetWrapper import GenericNNetWrapper
 from .SplendorNNet import SplendorNNet as nn_model
@@ -6,3 +7,13 @@ from .SplendorNNet import SplendorNNet as nn_model
 class NNetWrapper(GenericNNetWrapper):
 	def init_nnet(self, game, nn_args):
 		self.nnet = nn_model(game, nn_args)
+
+	def prepare_inference_nnet(self, nnet):
+		nnet = super().prepare_inference_nnet(nnet)
+		nnet.fuse_output_layers()
+		# Script parameter-free pooling layers, unless whole network is compiled. Only done on
+		# inference copy since a scripted module can't be pickled in 'full_model' of checkpoints
+		if not self.args.get('compile_inference'):
+			for name in ['partialgpool_1', 'flatten_and_gpool', 'partialgpool_4', 'partialgpool_5']:
+				setattr(nnet, name, torch.jit.script(getattr(nnet, name)))
+		return nnet
@@ -1,31 +1,53 @@
+from typing import Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-# Assume 3-dim tensor input N,C,L
+# Normalization over C,L of each sample (version>=2) doesn't depend on batch statistics, so batch=1 inference is sound
+def norm_layer(nb_channels, length, version):
+	return nn.LayerNorm([nb_channels, length]) if version >= 2 else nn.BatchNorm1d(nb_channels)
+
+# Pool all groups at once: view them as an extra dimension and reduce on it
+def gpool(x: torch.Tensor, nb_groups: int, nb_items_in_groups: int) -> Tuple[torch.Tensor, torch.Tensor]:
+	groups_for_gpool = x.unflatten(-1, [nb_groups, nb_items_in_groups])
+	return groups_for_gpool.amax(-1), groups_for_gpool.mean(-1)
+
+# Training only: pooling, concatenation and dropout in a single scripted graph, so that elementwise ops are fused
+@torch.jit.script
+def gpool_cat_dropout(x_pool: torch.Tensor, dense_result: torch.Tensor, nb_groups: int, nb_items_in_groups: int, p: float) -> torch.Tensor:
+	maxpool_result, avgpool_result = gpool(x_pool, nb_groups, nb_items_in_groups)
+	# In place like the eager path: backward of Linear/norm layer and of cat don't need their outputs
+	return F.dropout(torch.cat([maxpool_result, avgpool_result, F.relu_(dense_result)], -1), p, True, True)
+
+# Assume 3-dim tensor input N,C,L, dropout is applied on output
 class DenseAndPartialGPool(nn.Module):
-	def __init__(self, input_length, output_length, nb_groups=8, nb_items_in_groups=8, channels_for_batchnorm=0):
+	def __init__(self, input_length, output_length, nb_groups=8, nb_items_in_groups=8, channels_for_batchnorm=0, version=1):
 		super().__init__()
 		self.nb_groups = nb_groups
 		self.nb_items_in_groups = nb_items_in_groups
-		self.dense_input = input_length - nb_groups*nb_items_in_groups
+		self.length_to_pool = nb_groups*nb_items_in_groups
+		self.dense_input = input_length - self.length_to_pool
 		self.dense_output = output_length - 2*nb_groups
 		self.dense_part = nn.Sequential(
 			nn.Linear(self.dense_input, self.dense_output),
-			nn.BatchNorm1d(channels_for_batchnorm) if channels_for_batchnorm > 0 else nn.Identity()
+			norm_layer(channels_for_batchnorm, self.dense_output, version) if channels_for_batchnorm > 0 else nn.Identity()
 		)
-		self.maxpool = nn.MaxPool1d(nb_items_in_groups)
-		self.avgpool = nn.AvgPool1d(nb_items_in_groups)
 
-	def forward(self, x):
-		groups_for_gpool = x.split([self.nb_items_in_groups] * self.nb_groups + [self.dense_input], -1)
-		maxpool_results = [ self.maxpool(y) for y in groups_for_gpool[:-1] ]
-		avgpool_results = [ self.avgpool(y) for y in groups_for_gpool[:-1] ]
-		
-		dense_result = F.relu(self.dense_part(groups_for_gpool[-1]))
+	def __setstate__(self, state):
+		super().__setstate__(state)
+		# 'full_model' pickled in checkpoints made before length_to_pool was stored
+		if not hasattr(self, 'length_to_pool'):
+			self.length_to_pool = self.nb_groups*self.nb_items_in_groups
+
+	def forward(self, x, dropout: float = 0.):
+		x_pool, x_dense = x[..., :self.length_to_pool], x[..., self.length_to_pool:]
+		if self.training:
+			return gpool_cat_dropout(x_pool, self.dense_part(x_dense), self.nb_groups, self.nb_items_in_groups, dropout)
 
-		x = torch.cat(maxpool_results + avgpool_results + [dense_result], -1)
-		return x
+		# No dropout at inference
+		maxpool_result, avgpool_result = gpool(x_pool, self.nb_groups, self.nb_items_in_groups)
+		dense_result = F.relu_(self.dense_part(x_dense))
+		return torch.cat([maxpool_result, avgpool_result, dense_result], -1)
 
 # Assume 3-dim tensor input N,C,L, return N,1,L tensor
 class FlattenAndPartialGPool(nn.Module):
@@ -33,22 +55,18 @@ class FlattenAndPartialGPool(nn.Module):
 		super().__init__()
 		self.length_to_pool = length_to_pool
 		self.nb_channels_to_pool = nb_channels_to_pool
-		self.maxpool = nn.MaxPool1d(nb_channels_to_pool)
-		self.avgpool = nn.AvgPool1d(nb_channels_to_pool)
-		self.flatten = nn.Flatten()
 
 	def forward(self, x):
 		x_begin, x_end = x[:,:,:self.length_to_pool], x[:,:,self.length_to_pool:]
 		x_begin_firstC, x_begin_lastC = x_begin[:,:self.nb_channels_to_pool,:], x_begin[:,self.nb_channels_to_pool:,:]
-		# MaxPool1D only applies to last dimension, whereas we want to apply on C dimension here
-		x_begin_firstC = x_begin_firstC.transpose(-1, -2)
-		maxpool_result = self.maxpool(x_begin_firstC).transpose(-1, -2)
-		avgpool_result = self.avgpool(x_begin_firstC).transpose(-1, -2)
+		# Pooling on C dimension is a plain reduction, no need to transpose
+		maxpool_result = x_begin_firstC.amax(1)
+		avgpool_result = x_begin_firstC.mean(1)
 		x = torch.cat([
-			self.flatten(maxpool_result),
-			self.flatten(avgpool_result),
-			self.flatten(x_begin_lastC),
-			self.flatten(x_end)
+			maxpool_result,
+			avgpool_result,
+			x_begin_lastC.flatten(1),
+			x_end.flatten(1)
 		], 1)
 		return x.unsqueeze(1)
 
@@ -74,29 +92,29 @@ class SplendorNNet(nn.Module):
 					_init(module)
 
 		self.dense2d_1 = nn.Sequential(
-			nn.Linear(self.nb_vect, 128), nn.BatchNorm1d(7), nn.ReLU(),
-			nn.Linear(128, 128)                            , nn.ReLU(), # no batchnorm before max pooling
+			nn.Linear(self.nb_vect, 128), norm_layer(7, 128, self.version), nn.ReLU(inplace=True),
+			nn.Linear(128, 128)                            , nn.ReLU(inplace=True), # no batchnorm before max pooling
 		)
 
-		self.partialgpool_1 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=8, channels_for_batchnorm=7)
+		self.partialgpool_1 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=8, channels_for_batchnorm=7, version=self.version)
 
 		self.dense2d_2 = nn.Identity()
 		self.partialgpool_2 = nn.Identity()
 
 		self.dense2d_3 = nn.Sequential(
-			nn.Linear(128, 128)                   , nn.ReLU(), # no batchnorm before max pooling
+			nn.Linear(128, 128)                   , nn.ReLU(inplace=True), # no batchnorm before max pooling
 		)
 		self.flatten_and_gpool = FlattenAndPartialGPool(length_to_pool=64, nb_channels_to_pool=5)
 		self.dense1d_4 = nn.Sequential(
-			nn.Linear(64*4+(128-64)*7, 128), nn.ReLU(),
+			nn.Linear(64*4+(128-64)*7, 128), nn.ReLU(inplace=True),
 		)
-		self.partialgpool_4 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=4, channels_for_batchnorm=1)
+		self.partialgpool_4 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=4, channels_for_batchnorm=1, version=self.version)
 		
 		self.dense1d_5 = nn.Sequential(
-			nn.Linear(128, 128), nn.BatchNorm1d(1), nn.ReLU(),
-			nn.Linear(128, 128)                   , nn.ReLU(), # no batchnorm before max pooling
+			nn.Linear(128, 128), norm_layer(1, 128, self.version), nn.ReLU(inplace=True),
+			nn.Linear(128, 128)                   , nn.ReLU(inplace=True), # no batchnorm before max pooling
 		)
-		self.partialgpool_5 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=4, channels_for_batchnorm=1)
+		self.partialgpool_5 = DenseAndPartialGPool(128, 128, nb_groups=4, nb_items_in_groups=4, channels_for_batchnorm=1, version=self.version)
 
 		self.output_layers_PI = nn.Sequential(
 			nn.Linear(128, 128),
@@ -113,26 +131,48 @@ class SplendorNNet(nn.Module):
 			nn.Linear(128, self.num_scdiffs*self.scdiff_size)
 		)
 
-		self.register_buffer('lowvalue', torch.FloatTensor([-1e8]))
+		self.output_layers = None # all output heads merged, only for inference, see fuse_output_layers()
+		self.register_buffer('lowvalue', torch.FloatTensor([-1e8])) # not used anymore, kept so that existing checkpoints still load
 		for layer2D in [self.dense2d_1, self.partialgpool_1, self.dense2d_3, self.flatten_and_gpool]:
 			layer2D.apply(_init)
 		for layer1D in [self.dense1d_4, self.partialgpool_4, self.dense1d_5, self.partialgpool_5, self.output_layers_PI, self.output_layers_V, self.output_layers_SDIFF]:
 			layer1D.apply(_init)
 
+	def __setstate__(self, state):
+		super().__setstate__(state)
+		# 'full_model' pickled in checkpoints made before output heads could be merged
+		if not hasattr(self, 'output_layers'):
+			self.output_layers = None
+
 	def forward(self, input_data, valid_actions):
 		x = input_data.transpose(-1, -2).view(-1, self.vect_dim, self.nb_vect)
 		
 		x = self.dense2d_1(x)
-		x = F.dropout(self.partialgpool_1(x), p=self.args['dropout'], training=self.training)
+		x = self.partialgpool_1(x, self.args['dropout'])
 		x = F.dropout(self.dense2d_3(x), p=self.args['dropout'], training=self.training)
 		x = self.flatten_and_gpool(x)
 		x = F.dropout(self.dense1d_4(x)     , p=self.args['dropout'], training=self.training)
-		x = F.dropout(self.partialgpool_4(x), p=self.args['dropout'], training=self.training)
+		x = self.partialgpool_4(x, self.args['dropout'])
 		x = F.dropout(self.dense1d_5(x)     , p=self.args['dropout'], training=self.training)
-		x = F.dropout(self.partialgpool_5(x), p=self.args['dropout'], training=self.training)
+		x = self.partialgpool_5(x, self.args['dropout'])
 		
-		v = self.output_layers_V(x).squeeze(1)
-		sdiff = self.output_layers_SDIFF(x).squeeze(1)
-		pi = torch.where(valid_actions, self.output_layers_PI(x).squeeze(1), self.lowvalue)
-
-		return F.log_softmax(pi, dim=1), torch.tanh(v), F.log_softmax(sdiff.view(-1, self.num_scdiffs, self.scdiff_size).transpose(1,2), dim=1) # TODO
+		if self.output_layers is not None:
+			pi, v, sdiff = self.output_layers(x).squeeze(1).split(self.output_sizes, -1)
+		else:
+			pi, v, sdiff = self.output_layers_PI(x).squeeze(1), self.output_layers_V(x).squeeze(1), self.output_layers_SDIFF(x).squeeze(1)
+		pi = pi.float().masked_fill(~valid_actions, -1e8) # in fp32, -1e8 would overflow fp16 under autocast
+
+		return F.log_softmax(pi, dim=1), torch.tanh(v), F.log_softmax(sdiff.reshape(-1, self.num_scdiffs, self.scdiff_size).transpose(1,2), dim=1) # TODO
+
+	# Each output head is 2 Linear layers without activation in between, so it is equivalent to a
+	# single Linear. And as all heads share same input, they can be merged into one matmul
+	def fuse_output_layers(self):
+		weights, biases = [], []
+		with torch.no_grad():
+			for head in [self.output_layers_PI, self.output_layers_V, self.output_layers_SDIFF]:
+				weights.append(head[1].weight @ head[0].weight)
+				biases.append(head[1].weight @ head[0].bias + head[1].bias)
+			self.output_sizes = [w.shape[0] for w in weights]
+			self.output_layers = nn.Linear(weights[0].shape[1], sum(self.output_sizes), device=weights[0].device)
+			self.output_layers.weight.copy_(torch.cat(weights))
+			self.output_layers.bias.copy_(torch.cat(biases))
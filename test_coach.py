@@ -0,0 +1,174 @@
+"""
+
+    Tests of self-play and storage of training examples: parallel self-play,
+    ExamplesBuffer, conversion of examples saved in previous format, and
+    sampling across iterations.
+
+"""
+
+import argparse
+import os
+import pickle
+import tempfile
+import unittest
+import zlib
+from collections import deque
+
+import numpy as np
+
+from Coach import Coach, ExamplesBuffer
+from GenericNNetWrapper import GenericNNetWrapper
+from MCTS import MCTS
+from splendor.SplendorGame import SplendorGame
+from test_mcts import RandomNNet
+from utils import dotdict
+
+
+def make_coach(**kwargs):
+    # Coach without networks to train, self-play uses a network returning random policies
+    game = SplendorGame()
+    args = {
+        'numMCTSSims'     : 8,
+        'cpuct'           : 1.0,
+        'prob_fullMCTS'   : 1.,
+        'ratio_fullMCTS'  : 2,
+        'forced_playouts' : False,
+        'mcts_batch_size' : 1,
+        'no_mem_optim'    : False,
+        'tempThreshold'   : 10,
+        'numItersHistory' : 2,
+        'dirichletAlpha'  : 0.,
+    }
+    args.update(kwargs)
+    args = argparse.Namespace(**args) # like in main.py, sent to self-play processes
+    coach = Coach.__new__(Coach)
+    coach.game, coach.args, coach.trainExamplesHistory = game, args, []
+    coach.nnet = RandomNNetWrapper(game, {})
+    coach.mcts = MCTS(game, coach.nnet, args)
+    return coach
+
+
+class RandomNNetWrapper(RandomNNet):
+    # Rebuilt in self-play processes like a real wrapper: nnet_class(game, nn_args), then .nnet is set
+    def __init__(self, game, nn_args):
+        super().__init__(game)
+        self.args, self.nnet = nn_args, None
+
+
+def make_example(i):
+    # (board, pi, v, scdiff, valids, surprise), like Coach.executeEpisode()
+    return (np.full((3, 2), i, dtype=np.int8), np.full(4, i / 10.), np.array([1., -1.]), np.array([i, -i]), np.arange(4) % 2 == 0, float(i))
+
+
+class TestSelfPlayParallel(unittest.TestCase):
+
+    def test_all_episodes_received(self):
+        coach = make_coach(numEps=3, num_workers=2, maxlenOfQueue=100000)
+        buffer = ExamplesBuffer(coach.args.maxlenOfQueue)
+        self.assertEqual(coach.selfPlayParallel(buffer), 3)
+        self.assertGreaterEqual(len(buffer), 3) # at least one example per episode
+        self.assertEqual(buffer.arrays()[0].shape[1:], coach.game.getBoardSize())
+
+    def test_stop_at_saturation(self):
+        coach = make_coach(numEps=4, num_workers=2, maxlenOfQueue=5)
+        buffer = ExamplesBuffer(coach.args.maxlenOfQueue)
+        self.assertEqual(coach.selfPlayParallel(buffer), 1)
+        self.assertEqual(len(buffer), 5)
+
+
+class TestExamplesBuffer(unittest.TestCase):
+
+    def test_wrap_around(self):
+        buffer = ExamplesBuffer(3).extend([make_example(i) for i in range(5)])
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.cursor, 2)
+        boards = buffer.arrays()[0]
+        self.assertEqual(boards.shape, (3, 3, 2))
+        self.assertEqual(sorted(boards[:, 0, 0]), [2, 3, 4]) # oldest examples were overwritten
+        self.assertEqual(buffer.arrays()[-1].tolist(), [3., 4., 2.])
+
+    def test_reset_keeps_arrays(self):
+        buffer = ExamplesBuffer(3).extend([make_example(i) for i in range(2)])
+        fields = buffer.fields
+        buffer.reset().extend([make_example(7)])
+        self.assertEqual(len(buffer), 1)
+        self.assertIs(buffer.fields, fields)
+        self.assertEqual(buffer.arrays()[-1].tolist(), [7.])
+
+    def test_truncate(self):
+        buffer = ExamplesBuffer(10).extend([make_example(i) for i in range(5)])
+        buffer.truncate(3)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.arrays()[-1].tolist(), [0., 1., 2.])
+        buffer.extend([make_example(8)])
+        self.assertEqual(buffer.arrays()[-1].tolist(), [0., 1., 2., 8.])
+        buffer.truncate(6) # no effect when already shorter
+        self.assertEqual(len(buffer), 4)
+
+    def test_pickle_only_filled_rows(self):
+        buffer = ExamplesBuffer(100).extend([make_example(i) for i in range(4)])
+        loaded = pickle.loads(pickle.dumps(buffer))
+        self.assertEqual(len(loaded), 4)
+        self.assertTrue(all(array.shape[0] == 4 for array in loaded.fields))
+        for array, expected in zip(loaded.arrays(), buffer.arrays()):
+            self.assertTrue(np.array_equal(array, expected))
+            self.assertEqual(array.dtype, expected.dtype)
+
+        empty = pickle.loads(pickle.dumps(ExamplesBuffer(100)))
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.arrays(), [])
+
+    def test_preallocate(self):
+        coach = make_coach()
+        coach.preallocate(50)
+        self.assertEqual(len(coach.buffersPool), coach.args.numItersHistory + 1)
+        buffer = coach.buffersPool[0]
+        self.assertIsNotNone(buffer.fields)
+        self.assertEqual(len(buffer), 0)
+
+        # Arrays match examples of a real episode, so they are used as is
+        examples = coach.executeEpisode()
+        fields = buffer.fields
+        buffer.extend(examples)
+        self.assertIs(buffer.fields, fields)
+        for array, expected in zip(buffer.fields, ExamplesBuffer(50).extend(examples).fields):
+            self.assertEqual(array.shape, expected.shape)
+            self.assertEqual(array.dtype, expected.dtype)
+
+
+class TestLoadTrainExamples(unittest.TestCase):
+
+    def test_convert_previous_format(self):
+        uncompressed = deque([make_example(i) for i in range(3)], maxlen=10)
+        compressed = deque([zlib.compress(pickle.dumps(make_example(i)), level=1) for i in range(3, 8)], maxlen=10)
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'checkpoint.examples'), 'wb') as f:
+                pickle.dump([uncompressed, compressed], f)
+            coach = Coach.__new__(Coach) # only loading is tested, no need for game nor network
+            coach.args = dotdict({'load_folder_file': os.path.join(folder, 'best.pt'), 'numItersHistory': 5, 'maxlenOfQueue': 4})
+            coach.loadTrainExamples()
+
+        history = coach.trainExamplesHistory
+        self.assertTrue(all(isinstance(h, ExamplesBuffer) for h in history))
+        self.assertEqual([len(h) for h in history], [3, 4]) # second one truncated to maxlenOfQueue
+        self.assertEqual(history[0].arrays()[-1].tolist(), [0., 1., 2.])
+        self.assertEqual(history[1].arrays()[-1].tolist(), [3., 4., 5., 6.])
+        for array, expected in zip(history[1].arrays(), make_example(3)):
+            self.assertTrue(np.array_equal(array[0], expected))
+
+
+class TestPickExamples(unittest.TestCase):
+
+    def test_same_as_concatenated(self):
+        history = [ExamplesBuffer(5).extend([make_example(i) for i in range(5)]), ExamplesBuffer(5).extend([make_example(i) for i in range(10, 13)])]
+        parts = [h.arrays() for h in history]
+        concatenated = [np.concatenate(arrays) for arrays in zip(*parts)]
+        sample_ids = np.random.default_rng(0).choice(8, size=6, replace=False)
+        picked = GenericNNetWrapper.pick_examples(None, parts, sample_ids)
+        for array, expected in zip(picked, concatenated):
+            self.assertTrue(np.array_equal(array, expected[sample_ids]))
+            self.assertEqual(array.dtype, expected.dtype)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+
+    Tests that transformations applied on the inference copy of a network
+    don't change its outputs, compared to the original network in eval mode.
+
+"""
+
+import copy
+import unittest
+
+import torch
+import torch.nn as nn
+
+from GenericNNetWrapper import fuse_linear_batchnorm
+from splendor.NNet import NNetWrapper as SplendorNNetWrapper
+from splendor.SplendorGame import SplendorGame
+
+
+def randomize_batchnorms(module):
+    for m in module.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.running_mean.uniform_(-1., 1.)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 2.)
+            m.bias.data.uniform_(-1., 1.)
+
+
+class TestFuseLinearBatchnorm(unittest.TestCase):
+
+    def test_same_outputs(self):
+        torch.manual_seed(0)
+        sequential = nn.Sequential(nn.Linear(16, 8), nn.BatchNorm1d(1), nn.ReLU(), nn.Linear(8, 8), nn.BatchNorm1d(1))
+        randomize_batchnorms(sequential)
+        sequential.eval()
+        fused = copy.deepcopy(sequential)
+        fuse_linear_batchnorm(fused)
+
+        self.assertIs(type(fused[1]), nn.Identity)
+        self.assertIs(type(fused[4]), nn.Identity)
+        x = torch.randn(5, 1, 16)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(fused(x), sequential(x), atol=1e-5))
+
+    def test_several_channels_not_fused(self):
+        # Statistics differ per channel, they can't be folded in a Linear applied on last dim
+        sequential = nn.Sequential(nn.Linear(16, 8), nn.BatchNorm1d(3)).eval()
+        fuse_linear_batchnorm(sequential)
+        self.assertIs(type(sequential[1]), nn.BatchNorm1d)
+
+
+class TestSplendorInferenceNNet(unittest.TestCase):
+
+    def test_same_outputs(self):
+        # Inference copy has BatchNorm folded, output heads merged and pooling layers scripted
+        torch.manual_seed(0)
+        game = SplendorGame()
+        for nn_version in [1, 2]:
+            wrapper = SplendorNNetWrapper(game, dict(dropout=0.3, nn_version=nn_version))
+            randomize_batchnorms(wrapper.nnet)
+            wrapper.nnet.eval()
+            inference_nnet = wrapper.inference_nnet()
+            self.assertIsNot(inference_nnet, wrapper.nnet)
+            self.assertIsNone(wrapper.nnet.output_layers) # original network must stay untouched
+
+            boards = torch.randn(6, wrapper.nb_vect, wrapper.vect_dim)
+            valid_actions = torch.rand(6, wrapper.action_size) > 0.5
+            valid_actions[:, 0] = True
+            with torch.no_grad():
+                pi, v, sdiff = wrapper.nnet(boards, valid_actions)
+                pi_inf, v_inf, sdiff_inf = inference_nnet(boards, valid_actions)
+            self.assertTrue(torch.allclose(torch.exp(pi_inf), torch.exp(pi), atol=1e-4)) # log-probabilities
+            self.assertTrue(torch.allclose(v_inf, v, atol=1e-4))
+            self.assertTrue(torch.allclose(torch.exp(sdiff_inf), torch.exp(sdiff), atol=1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+
+    Tests of MCTS internals, using Splendor game and a fake neural network
+    returning random policies, so that no trained network is needed.
+
+"""
+
+import unittest
+
+import numpy as np
+
+from MCTS import MCTS, NAN, add_virtual_loss, revert_virtual_loss
+from splendor.SplendorGame import SplendorGame
+from utils import dotdict
+
+
+class RandomNNet():
+    def __init__(self, game, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.num_players = game.num_players
+
+    def predict(self, board, valid_actions):
+        pi, v = self.predict_batch(board[np.newaxis], valid_actions[np.newaxis])
+        return pi[0], v[0]
+
+    def predict_batch(self, boards, valid_actions):
+        pi = (self.rng.random(valid_actions.shape) + 0.01) * valid_actions
+        v = self.rng.uniform(-1., 1., (boards.shape[0], self.num_players))
+        return pi.astype(np.float32), v.astype(np.float32)
+
+
+class TestVirtualLoss(unittest.TestCase):
+
+    def test_revert_restores_exactly(self):
+        Qsa = np.array([NAN, 0.3, -0.7, 0.1], dtype=np.float64)
+        Nsa = np.array([0, 3, 7, 1], dtype=np.int64)
+        Qsa_before, Nsa_before = Qsa.copy(), Nsa.copy()
+
+        applied = [(a, ) + add_virtual_loss(Qsa, Nsa, a) for a in [0, 1, 1, 2, 0, 3]]
+        self.assertTrue((Nsa == Nsa_before + [2, 2, 1, 1]).all())
+        self.assertTrue((Qsa < Qsa_before)[1:].all() and Qsa[0] != NAN)
+
+        for a, q, n in reversed(applied):
+            revert_virtual_loss(Qsa, Nsa, a, q, n)
+        self.assertTrue(np.array_equal(Qsa, Qsa_before))
+        self.assertTrue(np.array_equal(Nsa, Nsa_before))
+        self.assertEqual(Qsa[0], NAN)
+
+
+class TestBatchSearch(unittest.TestCase):
+
+    def run_mcts(self, mcts_batch_size, numMCTSSims=100):
+        game = SplendorGame()
+        board = game.getCanonicalForm(game.getInitBoard(), 0)
+        args = dotdict({
+            'numMCTSSims'     : numMCTSSims,
+            'cpuct'           : 1.0,
+            'prob_fullMCTS'   : 1.,
+            'forced_playouts' : False,
+            'mcts_batch_size' : mcts_batch_size,
+            'no_mem_optim'    : False,
+        })
+        mcts = MCTS(game, RandomNNet(game), args)
+        mcts.getActionProb(board, temp=1, force_full_search=True)
+        return mcts, game.stringRepresentation(board)
+
+    def check_tree(self, mcts):
+        for Es, Vs, Ps, Ns, Qsa, Nsa, r in mcts.nodes_data.values():
+            if Ps is None:
+                continue
+            self.assertEqual(Ns, Nsa.sum())
+            self.assertTrue(((Qsa == NAN) == (Nsa == 0)).all()) # no virtual loss left
+
+    def test_same_visit_totals(self):
+        for mcts_batch_size in [1, 8, 16]:
+            mcts, root = self.run_mcts(mcts_batch_size)
+            # first simulation only expands root
+            self.assertEqual(mcts.nodes_data[root][5].sum(), 100 - 1)
+            self.check_tree(mcts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+
+    Tests of Splendor network layers, and compatibility with networks
+    pickled in existing checkpoints.
+
+"""
+
+import copy
+import os
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from splendor.SplendorNNet import DenseAndPartialGPool, FlattenAndPartialGPool
+
+
+SPLENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'splendor')
+
+
+# Original formulation, with one split and one pooling call per group
+def reference_dense_and_partial_gpool(layer, x):
+    groups = x.split([layer.nb_items_in_groups] * layer.nb_groups + [layer.dense_input], -1)
+    maxpool_results = [F.max_pool1d(y, layer.nb_items_in_groups) for y in groups[:-1]]
+    avgpool_results = [F.avg_pool1d(y, layer.nb_items_in_groups) for y in groups[:-1]]
+    return torch.cat(maxpool_results + avgpool_results + [F.relu(layer.dense_part(groups[-1]))], -1)
+
+# Original formulation, pooling on C dimension by transposing it to last dimension
+def reference_flatten_and_partial_gpool(layer, x):
+    x_begin, x_end = x[:,:,:layer.length_to_pool], x[:,:,layer.length_to_pool:]
+    x_begin_firstC, x_begin_lastC = x_begin[:,:layer.nb_channels_to_pool,:], x_begin[:,layer.nb_channels_to_pool:,:]
+    x_begin_firstC = x_begin_firstC.transpose(-1, -2)
+    maxpool_result = F.max_pool1d(x_begin_firstC, layer.nb_channels_to_pool).transpose(-1, -2)
+    avgpool_result = F.avg_pool1d(x_begin_firstC, layer.nb_channels_to_pool).transpose(-1, -2)
+    return torch.cat([maxpool_result.flatten(1), avgpool_result.flatten(1), x_begin_lastC.flatten(1), x_end.flatten(1)], 1).unsqueeze(1)
+
+
+class TestPoolingLayers(unittest.TestCase):
+
+    def test_dense_and_partial_gpool(self):
+        # Checkpoints rely on output layout: all max, then all avg, then dense part
+        torch.manual_seed(0)
+        x = torch.randn(5, 7, 128)
+        for nb_groups, nb_items_in_groups in [(4, 8), (4, 4), (8, 8)]:
+            layer = DenseAndPartialGPool(128, 128, nb_groups=nb_groups, nb_items_in_groups=nb_items_in_groups, channels_for_batchnorm=7)
+            with torch.no_grad():
+                layer.train()
+                self.assertTrue(torch.allclose(layer(x, 0.), reference_dense_and_partial_gpool(layer, x), atol=1e-6))
+                layer.eval()
+                expected = reference_dense_and_partial_gpool(layer, x)
+                self.assertTrue(torch.allclose(layer(x), expected, atol=1e-6))
+                self.assertTrue(torch.allclose(torch.jit.script(layer)(x), expected, atol=1e-6))
+
+    def test_flatten_and_partial_gpool(self):
+        torch.manual_seed(0)
+        x = torch.randn(5, 7, 128)
+        layer = FlattenAndPartialGPool(length_to_pool=64, nb_channels_to_pool=5)
+        expected = reference_flatten_and_partial_gpool(layer, x)
+        self.assertEqual(tuple(expected.shape), (5, 1, 64*4+(128-64)*7))
+        self.assertTrue(torch.allclose(layer(x), expected, atol=1e-6))
+        self.assertTrue(torch.allclose(torch.jit.script(layer)(x), expected, atol=1e-6))
+
+
+class TestPretrainedCheckpoints(unittest.TestCase):
+
+    def load_full_model(self, num_players):
+        # 'full_model' is a pickled module, not only weights
+        checkpoint = torch.load(os.path.join(SPLENDOR_DIR, f'pretrained_{num_players}players.pt'), map_location='cpu', weights_only=False)
+        return checkpoint['full_model']
+
+    def test_full_model_forward(self):
+        # Modules were pickled with attributes of older code, forward must still work on them
+        torch.manual_seed(0)
+        for num_players in [2, 3, 4]:
+            nnet = self.load_full_model(num_players).eval()
+            boards = torch.randn(3, nnet.nb_vect, nnet.vect_dim)
+            valid_actions = torch.rand(3, nnet.action_size) > 0.5
+            valid_actions[:, 0] = True
+            with torch.no_grad():
+                pi, v, sdiff = nnet(boards, valid_actions)
+            self.assertEqual(tuple(pi.shape), (3, nnet.action_size))
+            self.assertEqual(tuple(v.shape), (3, nnet.num_players))
+            self.assertTrue(torch.allclose(torch.exp(pi).sum(1), torch.ones(3), atol=1e-4))
+            self.assertTrue((torch.exp(pi)[~valid_actions] < 1e-6).all())
+
+            # Inference transformation works on them too
+            fused_nnet = copy.deepcopy(nnet)
+            fused_nnet.fuse_output_layers()
+            with torch.no_grad():
+                pi_fused, v_fused, _ = fused_nnet(boards, valid_actions)
+            self.assertTrue(torch.allclose(torch.exp(pi_fused), torch.exp(pi), atol=1e-4))
+            self.assertTrue(torch.allclose(v_fused, v, atol=1e-4))
+
+            # And training mode
+            nnet.train()
+            pi, v, sdiff = nnet(boards, valid_actions)
+            (pi.sum() + v.sum() + sdiff.sum()).backward()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -50,6 +50,7 @@ def next_best_move(game, nn_name, player):
 		'cpuct'           : additional_keys.get('cpuct'      , 1.0),
 		'prob_fullMCTS'   : 1.,
 		'forced_playouts' : False,
+		'mcts_batch_size' : 1,
 	})
 	mcts = MCTS(game, net, mcts_args)
 	